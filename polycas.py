@@ -4,14 +4,17 @@ from time import sleep
 from sys import exit
 from pathlib import Path
 from datetime import timedelta
-from numpy import array, arange, sin, pi
+from numpy import arange, sin, rint, pi, stack, concatenate, tile, full, zeros, ones
+from numpy import frombuffer, unpackbits, uint8
 import wave
+import re
 import struct
 
 from serial import Serial
 
 SYNC = b'\xe6'
 SOH  = b'\x01'
+SYNC_RUN = re.compile(SYNC + b'*')
 
 TYPE_DATA = b'\x00'
 TYPE_COMMENT = b'\x01'
@@ -28,29 +31,20 @@ class CassetteProgram:
     def __createChecksum(self, s):
         if s == b'':
             return b''
-        sum = 0
-        for b in s:
-            sum += b
-        sum %= 0x100
-        return bytes([(0x100-sum)%0x100])
+        return bytes([-sum(s) % 0x100])
 
-    def __createSection(self, address, data, sectiontype):
+    def _buildSection(self, address, data, sectiontype):
         if sectiontype == TYPE_EXEC:
             execaddr = address
             address = 0
         else:
             execaddr = address
-        a = self.name + \
-             bytes([address % 0x100, address // 0x100]) + \
-             bytes([len(data) % 0x100]) + \
-             bytes([execaddr % 0x100, execaddr // 0x100]) + \
-             sectiontype
+        a = self.name + struct.pack('<HBHc', address, len(data) & 0xFF, execaddr, sectiontype)
         if len(data) == 0:
             b = b''
         else:
             b = data
-        self.sections.append(self.header + a + self.__createChecksum(a) + b + self.__createChecksum(b))
-        self.size += len(self.sections[-1])
+        return self.header + a + self.__createChecksum(a) + b + self.__createChecksum(b)
              
     def setName(self, name):
         name = name.encode()
@@ -62,129 +56,118 @@ class CassetteProgram:
             name = name + (b' ' * (8-len(name)))
         self.name = name
 
+    def __addSection(self, section):
+        self.sections.append(section)
+        self.size += len(section)
+
     def createDataMessage(self, address, data):
-        self.__createSection(address, data, TYPE_DATA)
+        self.__addSection(self._buildSection(address, data, TYPE_DATA))
 
     def createCommentMessage(self, s):
-        self.__createSection(0x0000, s, TYPE_COMMENT)
+        self.__addSection(self._buildSection(0x0000, s, TYPE_COMMENT))
 
     def createEndMessage(self):
-        self.__createSection(0x0000, b'', TYPE_END)
+        self.__addSection(self._buildSection(0x0000, b'', TYPE_END))
 
     def createExecMessage(self, execaddr):
-        self.__createSection(execaddr, b'', TYPE_EXEC)
+        self.__addSection(self._buildSection(execaddr, b'', TYPE_EXEC))
 
-    def loadFromBin(self, infile, loadaddr, execaddr, name):
-        print('Creating cas object...')
-        self.setName(name)
-        self.createCommentMessage(b'\r\nLOADING START\r\n')
+    def sectionsFromBin(self, infile, loadaddr, execaddr):
+        # Generate the sections for a binary file one at a time
+        yield self._buildSection(0x0000, b'\r\nLOADING START\r\n', TYPE_COMMENT)
         with open(infile, 'rb') as f:
             address = loadaddr
             increment = 0x100
             data = f.read(increment)
             while len(data) != 0:
-                self.createDataMessage(address,data)
+                yield self._buildSection(address, data, TYPE_DATA)
                 address += increment
                 data = f.read(increment)
-            self.createCommentMessage(b'LOADING END\r\n')
-            if execaddr is not None:
-                self.createExecMessage(execaddr)
-            else:
-                self.createEndMessage()
+        yield self._buildSection(0x0000, b'LOADING END\r\n', TYPE_COMMENT)
+        if execaddr is not None:
+            yield self._buildSection(execaddr, b'', TYPE_EXEC)
+        else:
+            yield self._buildSection(0x0000, b'', TYPE_END)
+
+    def loadFromBin(self, infile, loadaddr, execaddr, name):
+        print('Creating cas object...')
+        self.setName(name)
+        sections = list(self.sectionsFromBin(infile, loadaddr, execaddr))
+        self.sections.extend(sections)
+        self.size += sum(map(len, sections))
 
     def load(self, infile):
         print('Loading cas file...')
         with open(infile, 'rb') as f:
-            self.size = 0
-            self.sections = []
-            index = 0
-            # Break into sections, read one at a time
-            while True:
-                section = b''
-                # Check if we are done
-                c = f.read(1)
-                if c == b'':
-                    break
-                # Read sync bytes
-                while c == SYNC:
-                    section += c
-                    c = f.read(1)
-                section += c
-                # Read header, including length   
-                c = f.read(16)
-                section += c
-                s = c[10]
-                if s == 0:
-                    length = 256
-                else:
-                    length = s
-                #print(index, length)
-                # Read the rest of the section
-                c = f.read(length)
-                section += c
-                index += 1
-                # Add to list of sections
-                self.sections.append(section)
-                self.size += len(self.sections[-1])
+            data = f.read()
+        self.size = 0
+        self.sections = []
+        pos = 0
+        # Break into sections
+        while pos < len(data):
+            # Skip sync bytes, the header starts with the byte after them
+            soh = SYNC_RUN.match(data, pos).end()
+            # Header is 16 bytes after SOH, including length
+            s = data[soh+11]
+            if s == 0:
+                length = 256
+            else:
+                length = s
+            # Add section and the rest of its data to list of sections
+            end = soh + 17 + length
+            self.sections.append(data[pos:end])
+            self.size += len(self.sections[-1])
+            pos = end
 
     def save(self, outfile):
         print('Saving cas file...')
         with open(outfile, 'wb') as f:
-            for section in self.sections:
-                f.write(section)
+            f.writelines(self.sections)
     
     def saveAsWavs(self, file_path):
         samplerate = 48000.0
         a = 30000.0
         # Save BYTE format wav file
-        t = arange(0,160.0)
-        f0 = a*sin(t*2*pi/160*4)
-        f1 = a*sin(t*2*pi/160*8)
-        f0 = f0.astype(int)
-        f1 = f1.astype(int)
-        buffers = [ struct.pack('<160h',*(f0)),
-                    struct.pack('<160h',*(f1)) ]
+        t = arange(160)
+        f0 = rint(a*sin(t*2*pi/160*4)).astype('<i2')
+        f1 = rint(a*sin(t*2*pi/160*8)).astype('<i2')
+        blocks = stack([f0, f1])
         print('Saving wav files...')
+        # bits of every byte value, lsb first
+        bits = unpackbits(arange(256, dtype=uint8)[:, None], axis=1, bitorder='little')
+        # waveform for every byte value, framed by one start bit (0),
+        # 8 data bits, and two stop bits (1)
+        frames = concatenate([zeros((256, 1), dtype=uint8), bits, ones((256, 2), dtype=uint8)], axis=1)
+        byte_wave = blocks[frames].reshape(256, -1)
         with wave.open(str(file_path.with_stem(file_path.stem + '_byte').with_suffix('.wav')),'wb') as wf:
             wf.setnchannels(1)   # Mono audio
             wf.setsampwidth(2)   # 2 bytes per sample (16-bit)
             wf.setframerate(samplerate)
             for section in self.sections:
-                for c in section:
-                    wf.writeframes(buffers[0])
-                    for bit in range(0,8):
-                        b = (c >> bit) & 0x01
-                        wf.writeframes(buffers[b])
-                    wf.writeframes(buffers[1])
-                    wf.writeframes(buffers[1])
+                wf.writeframes(byte_wave[frombuffer(section, dtype=uint8)].tobytes())
         # Save POLY format wav file
         # TBD - some filtering please?
-        HIGH = array([ a ] * 10)
-        LOW = array([ -a ] * 10)
-        HIGH = HIGH.astype(int)
-        LOW = LOW.astype(int)
-        HIGH = struct.pack('<10h',*(HIGH))
-        LOW = struct.pack('<10h',*(LOW))
-        buffers = [ HIGH+LOW, LOW+HIGH ]
+        HIGH = full(10, a)
+        LOW = full(10, -a)
+        blocks = stack([concatenate([HIGH, LOW]),
+                        concatenate([LOW, HIGH])]).astype('<i2')
+        byte_wave = blocks[bits].reshape(256, -1)
+        carrier = tile(blocks[0], 1200).tobytes()
         with wave.open(str(file_path.with_stem(file_path.stem + '_poly').with_suffix('.wav')),'wb') as wf:
             wf.setnchannels(1)   # Mono audio
             wf.setsampwidth(2)   # 2 bytes per sample (16-bit)
             wf.setframerate(samplerate)
             # 5 secs of carrier
-            for i in range(0,1200):
-                wf.writeframes(buffers[1])
+            wf.writeframes(tile(blocks[1], 1200).tobytes())
             for section in self.sections:
                 # 0.5 secs of carrier
-                for i in range(0,1200):
-                    wf.writeframes(buffers[0])
-                for c in section:
-                    for bit in range(0,8):
-                        b = (c >> bit) & 0x01
-                        wf.writeframes(buffers[b])
+                wf.writeframes(carrier)
+                wf.writeframes(byte_wave[frombuffer(section, dtype=uint8)].tobytes())
 
     def stream(self, port):
         print('Sending to serial port...')
-        ser = Serial(port, 300, stopbits=2, timeout=1, write_timeout=1)
+        # a full section takes about 11 secs to go out at 300 baud
+        ser = Serial(port, 300, stopbits=2, timeout=1, write_timeout=15)
         #print(ser.get_settings())
         sent_size = 0
         for section in self.sections:
@@ -196,9 +179,9 @@ class CassetteProgram:
         sleep(3)
 
     def send(self, ser, msg):
-        for i in range(0,len(msg)):
-            ser.write(msg[i:i+1])
-            sleep(11.0/300)
+        # the uart paces the bytes at 300 baud, wait for them to drain
+        ser.write(msg)
+        ser.flush()
 
 def main():
     # Parse Arguments